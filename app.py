@@ -1,12 +1,14 @@
 import streamlit as st
-import xml.etree.ElementTree as ET
-from pykml import parser
+from lxml import etree
 import os
-import math
-from collections import defaultdict
+from collections import Counter, defaultdict
 import pandas as pd
-from io import BytesIO
-import re
+from io import BytesIO, TextIOWrapper
+import csv
+import hashlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from kml_compute import DESCRIPTION_SAMPLES, compute, init_worker, split_placemarks
 
 # Set page config
 st.set_page_config(
@@ -27,134 +29,105 @@ except ImportError:
     except ImportError:
         EXCEL_ENGINE = None
 
-@st.cache_data
-def calculate_distance(coord1, coord2):
-    """Calculate distance between two coordinates (lon, lat) in meters using Haversine formula"""
-    lon1, lat1 = coord1
-    lon2, lat2 = coord2
-    
-    # Convert degrees to radians
-    lat1 = math.radians(lat1)
-    lon1 = math.radians(lon1)
-    lat2 = math.radians(lat2)
-    lon2 = math.radians(lon2)
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    radius_earth = 6371000  # Earth radius in meters
-    distance = radius_earth * c
-    
-    return distance
-
-@st.cache_data
-def calculate_linestring_length(coordinates):
-    """Calculate total length of LineString from coordinate list"""
-    total_length = 0.0
-    for i in range(len(coordinates)-1):
-        coord1 = coordinates[i]
-        coord2 = coordinates[i+1]
-        total_length += calculate_distance(coord1, coord2)
-    # Round to nearest whole number
-    return round(total_length)
-
-def remove_encoding_declaration(xml_content):
-    """Remove XML encoding declaration to avoid parsing issues"""
-    return re.sub(r'^\s*<\?xml[^>]*\?>', '', xml_content, flags=re.MULTILINE).strip()
+# Files smaller than this are parsed in-process rather than in a worker pool
+PARALLEL_MIN_BYTES = 32 * 1024 * 1024
 
 @st.cache_data
-def process_kml_file(uploaded_file):
-    """Process KML file and count all found labels"""
-    counts = defaultdict(int)
-    line_lengths = defaultdict(float)
+def _process_content(digest, _content, precision):
+    """Count all found labels in KML bytes, cached by their digest.
+    
+    The leading underscore keeps Streamlit from hashing the raw bytes on
+    every rerun; the small digest is the cache key instead.
+    """
+    counts = Counter()
+    line_lengths = Counter()
     descriptions = defaultdict(list)
     
+    workers = os.cpu_count() or 1
     try:
-        # Read the uploaded file as bytes first
-        content = uploaded_file.getvalue()
-        
-        try:
-            # First try parsing as bytes directly
-            doc = parser.fromstring(content)
-        except:
-            # If that fails, try decoding and removing encoding declaration
-            decoded_content = content.decode('utf-8')
-            cleaned_content = remove_encoding_declaration(decoded_content)
-            doc = parser.fromstring(cleaned_content)
-        
-        # Find all Placemarks in the document
-        placemarks = doc.findall('.//{http://www.opengis.net/kml/2.2}Placemark')
-        if not placemarks:
-            return counts, line_lengths, descriptions
-            
-        for pm in placemarks:
-            name = pm.find('{http://www.opengis.net/kml/2.2}name')
-            label = name.text.strip() if name is not None and name.text else "Unnamed"
-            
-            # Get description if available
-            desc = pm.find('{http://www.opengis.net/kml/2.2}description')
-            description = desc.text.strip() if desc is not None and desc.text else "No description"
-            descriptions[label].append(description)
-            
-            # Process Polygon/Point
-            if pm.find('.//{http://www.opengis.net/kml/2.2}Polygon') is not None:
-                counts[f"{label} (Polygon)"] += 1
-            elif pm.find('.//{http://www.opengis.net/kml/2.2}Point') is not None:
-                counts[f"{label} (Point)"] += 1
-            
-            # Process LineString
-            linestring = pm.find('.//{http://www.opengis.net/kml/2.2}LineString')
-            if linestring is not None:
-                coords = linestring.find('{http://www.opengis.net/kml/2.2}coordinates')
-                if coords is not None and coords.text:
-                    try:
-                        coord_list = []
-                        for coord_str in coords.text.strip().split():
-                            parts = coord_str.split(',')
-                            if len(parts) >= 2:
-                                lon, lat = float(parts[0]), float(parts[1])
-                                coord_list.append((lon, lat))
-                        
-                        if coord_list:
-                            length = calculate_linestring_length(coord_list)
-                            line_lengths[f"{label} (LineString)"] += length
-                    except ValueError as e:
-                        st.warning(f"Couldn't parse coordinates for {label}: {str(e)}")
-    
-    except ET.ParseError as e:
+        if len(_content) < PARALLEL_MIN_BYTES or workers == 1:
+            # Splitting holds every Placemark in memory and a pool costs far more
+            # to start than a small file takes to parse, so stay in-process
+            results = [compute(_content, precision)]
+        else:
+            # Only the picklable bytes cross the process boundary, not the UploadedFile.
+            # Spawned workers avoid forking a process that already runs Numba's thread pool.
+            chunks = split_placemarks(_content, workers)
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks) or 1),
+                                     mp_context=mp.get_context('spawn'),
+                                     initializer=init_worker) as executor:
+                futures = [executor.submit(compute, chunk, precision) for chunk in chunks]
+                # Worker failures (e.g. BrokenProcessPool) re-raise from result()
+                results = [future.result() for future in futures]
+    except etree.XMLSyntaxError as e:
         st.error(f"XML parsing error: {str(e)}")
+        return Counter(), {}, {}
     except Exception as e:
         st.error(f"Error processing KML file: {str(e)}")
+        return Counter(), {}, {}
     
-    # Round all accumulated lengths
-    line_lengths = {k: round(v) for k, v in line_lengths.items()}
+    # Merge in chunk order so description samples match a serial pass
+    for chunk_counts, chunk_lengths, chunk_descriptions, messages in results:
+        counts.update(chunk_counts)
+        line_lengths.update(chunk_lengths)
+        for label, samples in chunk_descriptions.items():
+            kept = descriptions[label]
+            kept.extend(samples[:DESCRIPTION_SAMPLES - len(kept)])
+        for level, message in messages:
+            if level == 'error':
+                st.error(message)
+            else:
+                st.warning(message)
     
-    return dict(counts), dict(line_lengths), dict(descriptions)
+    return counts, dict(line_lengths), dict(descriptions)
+
+def process_kml_file(uploaded_file, precision='f64'):
+    """Process KML file and count all found labels"""
+    content = uploaded_file.getvalue()
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    return _process_content(digest, content, precision)
+
+@st.cache_data
+def _build_frames(counts, line_lengths):
+    """Build the sorted counts and lengths DataFrames shared by the tabs and the downloads"""
+    df_counts = pd.DataFrame({'Count': counts}).sort_values(by='Count', ascending=False)
+    df_lengths = pd.DataFrame({'Length (m)': line_lengths}).sort_values(by='Length (m)', ascending=False)
+    df_lengths['Length (km)'] = (df_lengths['Length (m)'] / 1000).round(0)
+    return df_counts, df_lengths
+
+def _build_csv(counts, line_lengths):
+    """Write counts and lengths straight to CSV bytes, row by row"""
+    output = BytesIO()
+    text = TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(['', 'Count', 'Length (m)'])
+    writer.writerows((label, count, '') for label, count in counts.items())
+    writer.writerows((label, '', length) for label, length in line_lengths.items())
+    text.flush()
+    text.detach()
+    return output.getvalue()
 
 def display_results(counts, line_lengths, descriptions):
     """Display results in Streamlit"""
     st.subheader("📊 Processing Results")
     
+    df_counts, df_lengths = _build_frames(counts, line_lengths)
+    
     tab1, tab2 = st.tabs(["Feature Counts", "LineString Lengths"])
     
     with tab1:
         if counts:
             st.write("**Feature Counts by Label:**")
-            df_counts = pd.DataFrame.from_dict(counts, orient='index', columns=['Count'])
-            st.dataframe(df_counts.sort_values(by='Count', ascending=False))
+            st.dataframe(df_counts)
             
             st.write("**Sample Descriptions:**")
             try:
                 displayed_labels = set()
-                for i, (label, count) in enumerate(sorted(counts.items(), key=lambda x: x[1], reverse=True)):
-                    if i >= 3:
-                        break
+                for label, count in counts.most_common(3):
                     clean_label = label.split(" (")[0]
                     if clean_label not in displayed_labels:
                         displayed_labels.add(clean_label)
-                        desc_samples = descriptions.get(clean_label, ['No description'])[:3]
+                        desc_samples = descriptions.get(clean_label, ['No description'])[:DESCRIPTION_SAMPLES]
                         st.write(f"- **{clean_label}**: {', '.join(desc_samples)}")
             except Exception as e:
                 st.warning(f"Couldn't display descriptions: {str(e)}")
@@ -164,13 +137,11 @@ def display_results(counts, line_lengths, descriptions):
     with tab2:
         if line_lengths:
             st.write("**LineString Lengths by Label (meters):**")
-            df_lengths = pd.DataFrame.from_dict(line_lengths, orient='index', columns=['Length (m)'])
-            df_lengths['Length (km)'] = (df_lengths['Length (m)'] / 1000).round(0)
             
             # Format numbers without decimals
             pd.options.display.float_format = '{:,.0f}'.format
             
-            st.dataframe(df_lengths.sort_values(by='Length (m)', ascending=False))
+            st.dataframe(df_lengths)
         else:
             st.warning("No LineStrings found in the KML file")
     
@@ -180,10 +151,7 @@ def display_results(counts, line_lengths, descriptions):
     if counts or line_lengths:
         if EXCEL_ENGINE is None:
             st.warning("Excel export requires either xlsxwriter or openpyxl package. Showing data as CSV instead.")
-            csv_data = pd.concat([
-                pd.DataFrame.from_dict(counts, orient='index', columns=['Count']),
-                pd.DataFrame.from_dict(line_lengths, orient='index', columns=['Length (m)'])
-            ], axis=1).to_csv().encode('utf-8')
+            csv_data = _build_csv(counts, line_lengths)
             
             st.download_button(
                 label="Download CSV",
@@ -196,12 +164,9 @@ def display_results(counts, line_lengths, descriptions):
             output = BytesIO()
             with pd.ExcelWriter(output, engine=EXCEL_ENGINE) as writer:
                 if counts:
-                    df_counts = pd.DataFrame.from_dict(counts, orient='index', columns=['Count'])
                     df_counts.to_excel(writer, sheet_name='Feature Counts')
                 
                 if line_lengths:
-                    df_lengths = pd.DataFrame.from_dict(line_lengths, orient='index', columns=['Length (m)'])
-                    df_lengths['Length (km)'] = (df_lengths['Length (m)'] / 1000).round(0)
                     df_lengths.to_excel(writer, sheet_name='LineString Lengths')
             
             st.download_button(
@@ -0,0 +1,251 @@
+"""KML parsing and LineString measurement, kept free of Streamlit.
+
+The app submits these functions to worker processes, so they live in an
+importable module instead of the Streamlit script, which is re-executed on
+every rerun and can't be pickled by reference.
+"""
+import re
+from collections import Counter, defaultdict
+from io import BytesIO
+
+import numpy as np
+from lxml import etree
+
+# Numba is optional; fall back to plain NumPy when it isn't installed
+try:
+    from numba import njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+EARTH_RADIUS_M = 6371000  # Earth radius in meters
+DESCRIPTION_SAMPLES = 3  # Descriptions shown (and kept) per label
+
+# Coordinate precision: float32 halves memory traffic in the Haversine pass at
+# the cost of sub-meter error per point, which is fine for KML visualization
+PRECISIONS = {'f32': np.float32, 'f64': np.float64}
+
+# Namespace-qualified KML tags, built once at import
+_NS = '{http://www.opengis.net/kml/2.2}'
+_PLACEMARK = _NS + 'Placemark'
+_NAME = _NS + 'name'
+_DESCRIPTION = _NS + 'description'
+_POLYGON = _NS + 'Polygon'
+_POINT = _NS + 'Point'
+_LINESTRING = _NS + 'LineString'
+_COORDINATES = _NS + 'coordinates'
+_PLACEMARK_TAGS = (_NAME, _DESCRIPTION, _POLYGON, _POINT, _LINESTRING, _COORDINATES)
+_DIRECT_CHILD_TAGS = frozenset((_NAME, _DESCRIPTION))
+_KML_OPEN = b'<kml xmlns="http://www.opengis.net/kml/2.2">'
+_KML_CLOSE = b'</kml>'
+
+def haversine_segments(lons, lats):
+    """Haversine distances in meters between consecutive points (radian arrays)"""
+    dlat = np.diff(lats)
+    dlon = np.diff(lons)
+    a = np.sin(dlat/2)**2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(dlon/2)**2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _haversine_segments(lons, lats):
+        """Fused single-pass Haversine segment distances in meters over radian arrays"""
+        out = np.empty_like(lons[1:])
+        for i in prange(len(lons) - 1):
+            dlat = lats[i+1] - lats[i]
+            dlon = lons[i+1] - lons[i]
+            a = np.sin(dlat/2)**2 + np.cos(lats[i]) * np.cos(lats[i+1]) * np.sin(dlon/2)**2
+            out[i] = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        return out
+
+    # Compile once per process when this module is first imported (the
+    # Streamlit script reruns, but imported modules stay cached in sys.modules)
+    _haversine_segments(np.zeros(2), np.zeros(2))
+    _haversine_segments(np.zeros(2, np.float32), np.zeros(2, np.float32))
+
+def calculate_linestring_lengths(lon_arrays, lat_arrays):
+    """Calculate the length of every LineString in a single batched pass"""
+    sizes = np.fromiter((len(a) for a in lon_arrays), dtype=np.intp, count=len(lon_arrays))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    # Concatenating gives fresh contiguous arrays, so convert to radians in place
+    lons = np.concatenate(lon_arrays)
+    lats = np.concatenate(lat_arrays)
+    np.radians(lons, out=lons)
+    np.radians(lats, out=lats)
+    
+    if NUMBA_AVAILABLE:
+        segments = _haversine_segments(lons, lats)
+    else:
+        segments = haversine_segments(lons, lats)
+    
+    # Drop the segments joining the end of one LineString to the start of the next;
+    # the trailing zero keeps reduceat in range when the last LineString is a single point
+    segments[starts[1:] - 1] = 0
+    segments = np.append(segments, 0)
+    
+    # Sum in float64 even for float32 segments so long tracks don't drift,
+    # then round to nearest whole number
+    return np.rint(np.add.reduceat(segments, starts, dtype=np.float64))
+
+def _parse_lonlat(text, dtype):
+    """Parse 'lon,lat' tuples into lon and lat column views"""
+    coords = np.fromstring(text.replace(',', ' '), sep=' ', dtype=dtype).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+def _parse_lonlatalt(text, dtype):
+    """Parse 'lon,lat,alt' tuples into lon and lat column views, dropping altitude"""
+    coords = np.fromstring(text.replace(',', ' '), sep=' ', dtype=dtype).reshape(-1, 3)
+    return coords[:, 0], coords[:, 1]
+
+def _parse_tokens(text, dtype):
+    """Parse tuples one by one; handles mixed or unusual column counts"""
+    lons, lats = [], []
+    for coord_str in text.split():
+        parts = coord_str.split(',')
+        if len(parts) >= 2:
+            lons.append(float(parts[0]))
+            lats.append(float(parts[1]))
+    return np.array(lons, dtype=dtype), np.array(lats, dtype=dtype)
+
+_COORDINATE_PARSERS = {2: _parse_lonlat, 3: _parse_lonlatalt}
+_FIRST_TOKEN = re.compile(r'\s*(\S+)')
+
+def parse_coordinates(text, precision='f64'):
+    """Parse a KML coordinates string into separate lon and lat arrays"""
+    lons, lats = _parse_columns(text, precision)
+    # One NaN/inf would poison the whole batched sum, and the Numba kernel's
+    # fastmath assumes finite input; reject the line so only it gets skipped
+    if not (np.isfinite(lons).all() and np.isfinite(lats).all()):
+        raise ValueError("non-finite coordinate value")
+    return lons, lats
+
+def _parse_columns(text, precision):
+    """Pick the fixed-shape or token-wise parser for a coordinates string"""
+    dtype = PRECISIONS[precision]
+    # Altitude is optional; only the first tuple is inspected to pick the parser
+    first = _FIRST_TOKEN.match(text)
+    ncols = first.group(1).strip(',').count(',') + 1 if first else 0
+    parse = _COORDINATE_PARSERS.get(ncols)
+    if parse is not None:
+        try:
+            lons, lats = parse(text, dtype)
+        except ValueError:
+            pass
+        else:
+            # A mixed-altitude string can still reshape cleanly and pair the wrong
+            # values, e.g. '1,2 3,4,0 5,6,0 7,8' gives lons [1, 3, 0, 6, 7]; trust
+            # the fixed shape only if every row has exactly ncols - 1 commas
+            if text.count(',') == len(lons) * (ncols - 1):
+                return lons, lats
+    # Rows don't all share the first tuple's shape; bad numbers still raise ValueError
+    return _parse_tokens(text, dtype)
+
+def compute(content, precision='f64'):
+    """Count all found labels in a chunk of KML bytes.
+    
+    This may run in a worker process where Streamlit calls don't work, so
+    warnings and errors are returned as (level, message) pairs for the
+    caller to show.
+    """
+    counts = Counter()
+    line_lengths = defaultdict(float)
+    descriptions = defaultdict(list)
+    messages = []
+    
+    try:
+        # LineStrings are collected here and measured together after parsing
+        linestrings = []
+        
+        # Stream Placemarks so only one subtree is held in memory at a time;
+        # raw bytes go straight to lxml, which honours the embedded encoding declaration
+        placemarks = etree.iterparse(
+            BytesIO(content),
+            events=('end',),
+            tag=_PLACEMARK,
+            recover=True,
+            huge_tree=True,
+            remove_blank_text=True
+        )
+        
+        for _, pm in placemarks:
+            # Walk the Placemark subtree once, keeping the first match of each tag
+            found = {}
+            for el in pm.iter(*_PLACEMARK_TAGS):
+                tag = el.tag
+                if tag in found:
+                    continue
+                parent = el.getparent()
+                if tag in _DIRECT_CHILD_TAGS and parent is not pm:
+                    continue
+                if tag == _COORDINATES and parent is not found.get(_LINESTRING):
+                    continue
+                found[tag] = el
+            
+            name = found.get(_NAME)
+            label = name.text.strip() if name is not None and name.text else "Unnamed"
+            
+            # Keep only as many descriptions as the results view samples
+            samples = descriptions[label]
+            if len(samples) < DESCRIPTION_SAMPLES:
+                desc = found.get(_DESCRIPTION)
+                description = desc.text.strip() if desc is not None and desc.text else "No description"
+                samples.append(description)
+            
+            # Process Polygon/Point
+            if _POLYGON in found:
+                counts[f"{label} (Polygon)"] += 1
+            elif _POINT in found:
+                counts[f"{label} (Point)"] += 1
+            
+            # Process LineString
+            if _LINESTRING in found:
+                coords = found.get(_COORDINATES)
+                if coords is not None and coords.text:
+                    try:
+                        lons, lats = parse_coordinates(coords.text, precision)
+                        
+                        if len(lons):
+                            linestrings.append((f"{label} (LineString)", lons, lats))
+                    except ValueError as e:
+                        messages.append(('warning', f"Couldn't parse coordinates for {label}: {str(e)}"))
+            
+            # Free the processed Placemark and any already-handled siblings
+            pm.clear()
+            while pm.getprevious() is not None:
+                del pm.getparent()[0]
+        
+        if linestrings:
+            keys, lon_arrays, lat_arrays = zip(*linestrings)
+            for key, length in zip(keys, calculate_linestring_lengths(lon_arrays, lat_arrays)):
+                line_lengths[key] += float(length)
+    
+    except etree.XMLSyntaxError as e:
+        messages.append(('error', f"XML parsing error: {str(e)}"))
+    except Exception as e:
+        messages.append(('error', f"Error processing KML file: {str(e)}"))
+    
+    # Round all accumulated lengths
+    line_lengths = {k: round(v) for k, v in line_lengths.items()}
+    
+    return counts, dict(line_lengths), dict(descriptions), messages
+
+def split_placemarks(content, n_chunks):
+    """Split KML bytes into up to n_chunks small KML documents of whole Placemarks"""
+    placemarks = []
+    for _, pm in etree.iterparse(BytesIO(content), events=('end',), tag=_PLACEMARK,
+                                 recover=True, huge_tree=True, remove_blank_text=True):
+        placemarks.append(etree.tostring(pm, with_tail=False))
+        pm.clear()
+        while pm.getprevious() is not None:
+            del pm.getparent()[0]
+    
+    chunk_size = max(1, -(-len(placemarks) // n_chunks))
+    return [
+        _KML_OPEN + b''.join(placemarks[i:i + chunk_size]) + _KML_CLOSE
+        for i in range(0, len(placemarks), chunk_size)
+    ]
+
+def init_worker():
+    """Pool initializer: one Numba thread per worker, so N workers use N threads, not N²"""
+    if NUMBA_AVAILABLE:
+        set_num_threads(1)